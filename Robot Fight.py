@@ -3,6 +3,14 @@ from pygame.locals import *
 from collections import namedtuple
 import random
 import csv
+import threading
+import time
+import bisect
+import math
+import hashlib
+import sqlite3
+import struct
+import argparse
 
 genome_fields = [
     'chest_size',
@@ -25,22 +33,44 @@ genome_fields = [
 
 Genome = namedtuple('Genome', genome_fields)
 
+snapshot_fields = [
+    'sprites',
+    'genome',
+    'attacker_hp',
+    'defender_hp',
+    'gen_num',
+    'match_num',
+    'frame',
+    'sim_fps'
+    ]
+
+Snapshot = namedtuple('Snapshot', snapshot_fields)
+
+trace_fields = [
+    'gen_num',
+    'match_num',
+    'seed',
+    'frames',
+    'genome'
+    ]
+
+TraceRecord = namedtuple('TraceRecord', trace_fields)
 
-class RobotFight():
+
+class Window():
 
     SCREEN_WIDTH = 1000
     SCREEN_HEIGHT = 500
     FPS = 60
+    WARP_LEVELS = [1, 2, 4, 8, 16, 32, 64, 128, 0]  # 0 = As Fast As Possible
 
-    def __init__(self, size, defender):
+    def __init__(self):
         """
-        Initialize the RobotFight game.
-        :param size: Number of bots for each generation.
-        :param defender: Robot of defender to test against.
+        Open the pygame window, with its displays and warp controls.
         """
         pygame.init()
 
-        self.size = (RobotFight.SCREEN_WIDTH, RobotFight.SCREEN_HEIGHT)
+        self.size = (Window.SCREEN_WIDTH, Window.SCREEN_HEIGHT)
         self.screen = pygame.display.set_mode(self.size)
         self.bg_color = (255, 255, 255)
 
@@ -52,77 +82,373 @@ class RobotFight():
         self.gen_display = Display(0, 25)
         self.att_hp_display = Display(0, 50)
         self.def_hp_display = Display(0, 75)
+        self.speed_display = Display(0, 100)
+
+        self.warp_index = 0
+        self.sim_frames = 0
+        self.sim_fps = 0
+        self.sim_fps_time = time.perf_counter()
+
+    def handle_event(self, event):
+        """
+        Handle closing the window and changing the warp level.
+        :param event: PyGame event to handle.
+        """
+
+        if event.type == QUIT:
+            self.running = False
+
+        if event.type == KEYDOWN:
+            if event.key == K_UP:
+                self.change_warp(1)
+            elif event.key == K_DOWN:
+                self.change_warp(-1)
+
+    def change_warp(self, amount):
+        """
+        Change the number of simulation steps run per display frame.
+        :param amount: Number of warp levels to move up or down.
+        """
+
+        self.warp_index += amount
+        self.warp_index = max(0, self.warp_index)
+        self.warp_index = min(len(Window.WARP_LEVELS) - 1,
+                              self.warp_index)
+
+    def update_sim_fps(self):
+        """
+        Recalculate the simulated frames per second, once a second.
+        """
+
+        now = time.perf_counter()
+        if now - self.sim_fps_time >= 1:
+            self.sim_fps = self.sim_frames / (now - self.sim_fps_time)
+            self.sim_frames = 0
+            self.sim_fps_time = now
+
+    def take_snapshot(self, match, gen_num, match_num):
+        """
+        Return an immutable Snapshot of the match.
+        :param match: Match to take the snapshot of.
+        :param gen_num: Generation of the match.
+        :param match_num: Number of the match within its generation.
+        """
+
+        attacker = match.get_attacker()
+        defender = match.get_defender()
+
+        return Snapshot(
+            sprites=match.snapshot(),
+            genome=attacker.genome,
+            attacker_hp=attacker.hp,
+            defender_hp=defender.hp,
+            gen_num=gen_num,
+            match_num=match_num,
+            frame=match.match_timer,
+            sim_fps=self.sim_fps)
+
+    def render(self, snapshot):
+        """
+        Draw the snapshot and displays, then wait for the next frame.
+        :param snapshot: Snapshot to draw.
+        """
+
+        self.screen.fill(self.bg_color)
+        for rect, color in snapshot.sprites:
+            self.screen.fill(color, rect)
+        self.draw_displays(snapshot)
+
+        self.timer.tick(Window.FPS)
+        pygame.display.update()
+
+    def draw_displays(self, snapshot):
+        """
+        Generate messages and draw displays to the screen.
+        :param snapshot: Snapshot of the simulation to describe.
+        """
+        
+        genome_text = '{}:{}:{}:{}:{}:{}:{}:{}:{}:{}:{}:{}:{}:{}:{}:{}'
+        genome_text = genome_text.format(*snapshot.genome)
+        self.genome_display.draw(genome_text, self.screen)
+
+        att_hp_text = 'Attacker HP: {}'
+        att_hp_text = att_hp_text.format(snapshot.attacker_hp)
+        self.att_hp_display.draw(att_hp_text, self.screen)
+
+        def_hp_text = 'Defender HP: {}'
+        def_hp_text = def_hp_text.format(snapshot.defender_hp)
+        self.def_hp_display.draw(def_hp_text, self.screen)
+
+        gen_text = 'Generation: {}  Match: {}'
+        gen_text = gen_text.format(snapshot.gen_num, snapshot.match_num)
+        self.gen_display.draw(gen_text, self.screen)
+
+        warp = Window.WARP_LEVELS[self.warp_index]
+        speed_text = 'Speed: {}  Sim FPS: {:.0f}  Frame: {}'
+        speed_text = speed_text.format('{}x'.format(warp) if warp else 'Max',
+                                       snapshot.sim_fps, snapshot.frame)
+        self.speed_display.draw(speed_text, self.screen)
+
+
+class RobotFight(Window):
+
+    MAX_SEED = 2 ** 32 - 1  # Seeds are stored as 32 bit in a MatchTrace.
+
+    def __init__(self, size, defender, steady_state=False,
+                 selection='truncation', store_path=None, seed=None,
+                 trace_path=None):
+        """
+        Initialize the RobotFight game.
+        :param size: Number of bots for each generation.
+        :param defender: Robot of defender to test against.
+        :param steady_state: Breed a steady state Population instead of
+        whole Generations.
+        :param selection: Parent selection mode of each Generation.
+        :param store_path: Path of a ResultStore database to reuse match
+        results from, or None to simulate every match.
+        :param seed: Seed of the run, or None for a random one.
+        :param trace_path: Path to record a MatchTrace of every match to,
+        or None to not record one.
+        """
+        Window.__init__(self)
+
+        self.snapshots = [None, None]
+        self.front_snapshot = 0
+        self.skip_requested = False
+        self.sim_thread = None
+
+        if seed is None:
+            seed = random.getrandbits(32)
+        elif not 0 <= seed <= RobotFight.MAX_SEED:
+            raise ValueError('Seed must be between 0 and {}'.format(
+                RobotFight.MAX_SEED))
+        self.seed = seed
+        self.rng = random.Random(seed)
         
-        self.current_gen = Generation.new_random_generation(size)
+        if steady_state and selection != 'truncation':
+            raise ValueError('A steady state Population only supports '
+                             'truncation selection')
+
+        if steady_state:
+            self.current_gen = None
+            self.population = Population(size, rng=self.rng)
+        else:
+            self.current_gen = Generation.new_random_generation(
+                size, selection=selection, rng=self.rng)
+            self.population = None
+
         self.match = None
         self.gen_iter = None
         self.gen_num = 1
-        self.match_num = 1
+        self.match_num = 0
 
         self.defender = defender
         self.defender.direction = -1
 
+        if store_path is None:
+            self.store = None
+        else:
+            self.store = ResultStore(store_path, self.defender)
+
+        if trace_path is None:
+            self.trace = None
+        else:
+            self.trace = MatchTrace(trace_path, self.seed, self.defender)
+
         self.out_data = []
 
     def start(self):
         """
         Start the RobotFight simulation.
         """
-        self.gen_iter = iter(self.current_gen)
-        self.match = Match(next(self.gen_iter), self.defender)
+        self.gen_iter = self.round_robots()
 
+        print('Seed: {}'.format(self.seed))
+        print()
         print('New Round: Generation 1')
         print('=========')
+
+        self.next_match()
+
+        self.publish_snapshot()
+        self.sim_thread = threading.Thread(target=self.simulate,
+                                           name='Simulation')
+        self.sim_thread.start()
+
         self.main_loop()
 
     def main_loop(self):
         """
-        Begin the main loop of the simulation.
+        Begin the main loop of the window. Only renders the latest snapshot
+        published by the simulation thread.
         """
         
-        while(self.running):
+        try:
+            while(self.running):
+
+                for event in pygame.event.get():
+                    self.handle_event(event)
+
+                    if event.type == KEYDOWN and event.key == K_n:
+                        self.skip_requested = True
 
-            for event in pygame.event.get():
-                if event.type == QUIT:
+                if not self.sim_thread.is_alive():
                     self.running = False
 
-                if event.type == KEYDOWN:
-                    if event.key == K_n:
-                        self.match.end()
+                self.render(self.snapshots[self.front_snapshot])
+        finally:
+            self.running = False
+            self.sim_thread.join()
 
-            if self.match.running:
-                self.match.update()
+            if self.store is not None:
+                self.store.close()
 
-                self.screen.fill(self.bg_color)
-                self.match.draw(self.screen)
-                self.draw_displays()
+            if self.trace is not None:
+                self.trace.close()
 
-                if self.match.finished():
-                    # print()
-                    # print(self.match.get_attacker().genome)
-                    print('    ', self.match.get_attacker().fitness,
-                          self.match.end_message)
+            with open('out.csv', 'w', newline='') as csvfile:
+                writer = csv.writer(csvfile)
+                for row in self.out_data:
+                    writer.writerow(row)
 
-                    self.log_match()
+            pygame.quit()
+
+    def simulate(self):
+        """
+        Run the simulation until the window closes. Runs in its own thread,
+        paced by the current warp level, and never waits on the renderer.
+        """
+
+        frame_time = 1 / RobotFight.FPS
+        next_frame = time.perf_counter()
+
+        while(self.running):
+            if self.skip_requested:
+                self.skip_requested = False
+                attacker = self.match.get_attacker()
+                self.match.end()
 
-                    self.match.end()
-                    
+                # Skipped matches are logged, but never stored or told to
+                # a Population, since their result is incomplete.
+                print('    ', attacker.fitness, 'Skipped!')
+                self.log_match(attacker, 'Skipped!')
+
+                self.next_match()
+
+            warp = RobotFight.WARP_LEVELS[self.warp_index]
+
+            if warp:
+                for i in range(warp):
+                    self.step()
             else:
-                try:
-                    self.match = Match(next(self.gen_iter), self.defender)
-                    self.match_num += 1
-                except StopIteration:
-                    self.new_round()
-                
-            self.timer.tick(self.FPS)
-            pygame.display.update()
-
-        with open('out.csv', 'w', newline='') as csvfile:
-            writer = csv.writer(csvfile)
-            for row in self.out_data:
-                writer.writerow(row)
-        
-        pygame.quit()
+                deadline = time.perf_counter() + frame_time
+                while time.perf_counter() < deadline:
+                    self.step()
+
+            self.publish_snapshot()
+
+            self.update_sim_fps()
+
+            now = time.perf_counter()
+
+            next_frame += frame_time
+            if warp and next_frame > now:
+                time.sleep(next_frame - now)
+            else:
+                next_frame = now
+
+    def publish_snapshot(self):
+        """
+        Write the current match state to the back snapshot buffer, then swap
+        it to the front for the renderer.
+        """
+
+        snapshot = self.take_snapshot(self.match, self.gen_num,
+                                      self.match_num)
+
+        back_snapshot = 1 - self.front_snapshot
+        self.snapshots[back_snapshot] = snapshot
+        self.front_snapshot = back_snapshot
+
+    def step(self):
+        """
+        Advance the current match by a single frame.
+        """
+
+        self.match.update()
+        self.sim_frames += 1
+
+        if self.match.finished():
+            attacker = self.match.get_attacker()
+
+            # print()
+            # print(attacker.genome)
+            print('    ', attacker.fitness, self.match.end_message)
+
+            self.match.end()
+
+            self.log_match(attacker, self.match.end_message)
+
+            if self.store is not None:
+                self.store.record(attacker.genome, attacker.fitness,
+                                  attacker.match_time,
+                                  self.match.end_message)
+
+            if self.population is not None:
+                self.population.tell(attacker)
+
+            self.next_match()
+
+    def next_match(self):
+        """
+        Start the match for the next robot without a stored result.
+        """
+
+        robot = self.next_robot()
+        while self.running and self.load_result(robot):
+            robot = self.next_robot()
+
+        self.match = Match(robot, self.defender)
+
+    def next_robot(self):
+        """
+        Return the next robot to evaluate, starting a new round if the
+        Generation is done.
+        """
+
+        try:
+            robot = next(self.gen_iter)
+        except StopIteration:
+            self.new_round()
+            robot = next(self.gen_iter)
+
+        self.match_num += 1
+        return robot
+
+    def load_result(self, robot):
+        """
+        Apply the stored result of the robot's genome, if there is one.
+        Returns True if the match does not need to be simulated.
+        :param robot: Robot about to be evaluated.
+        """
+
+        if self.store is None:
+            return False
+
+        result = self.store.lookup(robot.genome)
+        if result is None:
+            return False
+
+        robot.fitness, robot.match_time, end_message = result
+
+        print('    ', robot.fitness, end_message, '(Stored)')
+
+        self.log_match(robot, end_message)
+
+        if self.population is not None:
+            self.population.tell(robot)
+
+        return True
 
     def new_round(self):
         """
@@ -130,42 +456,32 @@ class RobotFight():
         """
         
         self.gen_num += 1
-        self.match_num = 1
+        self.match_num = 0
         print()
         print('New Round: Generation {0}'.format(self.gen_num))
         print('=========')
-        self.current_gen = self.current_gen.breed()
-        self.gen_iter = iter(self.current_gen)
-        self.match = Match(next(self.gen_iter), self.defender)
+        if self.population is None:
+            self.current_gen = self.current_gen.breed()
+        self.gen_iter = self.round_robots()
 
-    def draw_displays(self):
+    def round_robots(self):
         """
-        Generate messages and draw displays to the screen.
+        Return an iterator over the robots to evaluate this round. With a
+        steady state Population, a round is simply the next size candidates.
         """
-        
-        genome_text = '{}:{}:{}:{}:{}:{}:{}:{}:{}:{}:{}:{}:{}:{}:{}:{}'
-        genome_text = genome_text.format(*self.match.get_attacker().genome)
-        self.genome_display.draw(genome_text, self.screen)
-
-        att_hp_text = 'Attacker HP: {}'
-        att_hp_text = att_hp_text.format(self.match.get_attacker().hp)
-        self.att_hp_display.draw(att_hp_text, self.screen)
 
-        def_hp_text = 'Defender HP: {}'
-        def_hp_text = def_hp_text.format(self.match.get_defender().hp)
-        self.def_hp_display.draw(def_hp_text, self.screen)
-
-        gen_text = 'Generation: {}'
-        gen_text = gen_text.format(self.gen_num)
-        self.gen_display.draw(gen_text, self.screen)
+        if self.population is None:
+            return iter(self.current_gen)
+        else:
+            return self.population.candidates(self.population.size)
 
-    def log_match(self):
+    def log_match(self, att, end_message):
         """
         Logs the match in out_data.
+        :param att: Attacking Robot of the match.
+        :param end_message: How the match ended.
         """
         row = []
-
-        att = self.match.get_attacker()
         
         row.append(self.gen_num)
         row.append(self.match_num)
@@ -173,12 +489,250 @@ class RobotFight():
         row += att.genome
         row.append(att.match_time / RobotFight.FPS)
         row.append(att.fitness)
-        row.append(self.match.end_message)
+        row.append(end_message)
         row.append(att.left_parent)
         row.append(att.right_parent)
 
         self.out_data.append(row)
 
+        if self.trace is not None:
+            self.trace.record(self.gen_num, self.match_num, att)
+
+
+class Replay(Window):
+
+    def __init__(self, path, gen_num, match_num):
+        """
+        Initialize a viewer for one match recorded in a MatchTrace.
+        :param path: Path of the trace file.
+        :param gen_num: Generation of the match to replay.
+        :param match_num: Number of the match within its generation.
+        """
+
+        run_seed, defender_seed, defender_genome, records = \
+                  MatchTrace.read(path)
+
+        for record in records:
+            if record.gen_num == gen_num and record.match_num == match_num:
+                self.record = record
+                break
+        else:
+            raise ValueError('No match {} of generation {} in {}'.format(
+                match_num, gen_num, path))
+
+        Window.__init__(self)
+
+        attacker = Robot(self.record.genome, seed=self.record.seed)
+        defender = Robot(defender_genome, direction=-1, seed=defender_seed)
+        self.match = Match(attacker, defender)
+
+    def start(self):
+        """
+        Replay the match until the window is closed. The match is rebuilt
+        from its genomes, and stops at the frame it ended at in the run.
+        """
+
+        try:
+            while(self.running):
+
+                for event in pygame.event.get():
+                    self.handle_event(event)
+
+                warp = Window.WARP_LEVELS[self.warp_index]
+                if not warp:
+                    warp = self.record.frames
+
+                for i in range(warp):
+                    if self.match.match_timer >= self.record.frames \
+                       or self.match.finished():
+                        break
+                    self.match.update()
+                    self.sim_frames += 1
+
+                self.update_sim_fps()
+
+                self.render(self.take_snapshot(self.match,
+                                               self.record.gen_num,
+                                               self.record.match_num))
+        finally:
+            pygame.quit()
+
+
+class ResultStore():
+
+    BATCH_SIZE = 100
+
+    @staticmethod
+    def genome_hash(genome):
+        return hashlib.sha1(repr(tuple(genome)).encode()).hexdigest()
+
+    @staticmethod
+    def fingerprint(defender):
+        """
+        Return a hash of the defender genome and every rule constant that
+        affects a match result, so changing any of them invalidates the
+        stored results.
+        :param defender: Defending Robot the results are against.
+        """
+
+        rules = (
+            tuple(defender.genome),
+            defender.direction,
+            RobotFight.SCREEN_WIDTH,
+            RobotFight.SCREEN_HEIGHT,
+            RobotFight.FPS,
+            Match.MAX_TIME,
+            Robot.GRAVITY,
+            Robot.OOB_LIMIT,
+            Bullet.SPEED,
+            Bullet.DAMAGE,
+            MeleeRange.SIZE,
+            MeleeRange.DAMAGE
+            )
+
+        return hashlib.sha1(repr(rules).encode()).hexdigest()
+
+    def __init__(self, path, defender):
+        """
+        Open the SQLite result store, creating it if needed. The database is
+        in WAL mode, so several runs can read it while one writes.
+        :param path: Path of the database file.
+        :param defender: Defending Robot the results are against.
+        """
+
+        self.fingerprint = ResultStore.fingerprint(defender)
+        self.pending = {}
+
+        self.connection = sqlite3.connect(path, timeout=30,
+                                          check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            'genome TEXT, '
+            'fingerprint TEXT, '
+            'fitness INTEGER, '
+            'match_time INTEGER, '
+            'end_message TEXT, '
+            'PRIMARY KEY (genome, fingerprint))')
+        self.connection.commit()
+
+    def lookup(self, genome):
+        """
+        Return the stored (fitness, match_time, end_message) of the genome,
+        or None if it has not been simulated under the current rules.
+        :param genome: Genome of the attacker.
+        """
+
+        key = ResultStore.genome_hash(genome)
+
+        if key in self.pending:
+            return self.pending[key]
+
+        row = self.connection.execute(
+            'SELECT fitness, match_time, end_message FROM results '
+            'WHERE genome = ? AND fingerprint = ?',
+            (key, self.fingerprint)).fetchone()
+
+        return row
+
+    def record(self, genome, fitness, match_time, end_message):
+        """
+        Queue the result of a finished match, writing the queue once it
+        reaches BATCH_SIZE.
+        :param genome: Genome of the attacker.
+        :param fitness: Fitness of the attacker.
+        :param match_time: Length of the match, in frames.
+        :param end_message: How the match ended.
+        """
+
+        key = ResultStore.genome_hash(genome)
+        self.pending[key] = (fitness, match_time, end_message)
+
+        if len(self.pending) >= ResultStore.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """
+        Write all queued results to the database.
+        """
+
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+            [(key, self.fingerprint) + result
+             for key, result in self.pending.items()])
+        self.connection.commit()
+        self.pending = {}
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+
+class MatchTrace():
+
+    MAGIC = b'RFT1'
+    HEADER = struct.Struct('<4sII16b')  # Magic, Run Seed, Defender
+    RECORD = struct.Struct('<IIIH16b')  # Generation, Match, Seed, Frames, Genome
+
+    @classmethod
+    def read(cls, path):
+        """
+        Return the run seed, defender seed, defender genome and list of
+        TraceRecords of a trace file.
+        :param path: Path of the trace file.
+        """
+
+        with open(path, 'rb') as tracefile:
+            data = tracefile.read()
+
+        if len(data) < cls.HEADER.size:
+            raise ValueError('Not a match trace: {}'.format(path))
+
+        header = cls.HEADER.unpack_from(data)
+        if header[0] != cls.MAGIC:
+            raise ValueError('Not a match trace: {}'.format(path))
+
+        # A run killed mid write can leave a partial last record.
+        records = []
+        for offset in range(cls.HEADER.size,
+                            len(data) - cls.RECORD.size + 1,
+                            cls.RECORD.size):
+            values = cls.RECORD.unpack_from(data, offset)
+            records.append(TraceRecord(*values[:4], Genome(*values[4:])))
+
+        return header[1], header[2], Genome(*header[3:]), records
+
+    def __init__(self, path, run_seed, defender):
+        """
+        Start a trace file. Matches are fully determined by the genomes and
+        how many frames they ran, so that is all each record keeps. The
+        seed only restores the attacker's color.
+        :param path: Path of the trace file.
+        :param run_seed: Seed of the run.
+        :param defender: Defending Robot of every match.
+        """
+
+        self.tracefile = open(path, 'wb')
+        self.tracefile.write(MatchTrace.HEADER.pack(
+            MatchTrace.MAGIC, run_seed, defender.seed, *defender.genome))
+        self.tracefile.flush()
+
+    def record(self, gen_num, match_num, attacker):
+        """
+        Write the record of a finished match.
+        :param gen_num: Generation of the match.
+        :param match_num: Number of the match within its generation.
+        :param attacker: Attacking Robot of the match.
+        """
+
+        self.tracefile.write(MatchTrace.RECORD.pack(
+            gen_num, match_num, attacker.seed, attacker.match_time,
+            *attacker.genome))
+        self.tracefile.flush()
+
+    def close(self):
+        self.tracefile.close()
+
 
 class Display():
 
@@ -267,6 +821,18 @@ class Match():
         self.att_melee.draw(screen)
         self.def_melee.draw(screen)
 
+    def snapshot(self):
+        """
+        Return an immutable copy of the rect and color of every sprite, in
+        drawing order.
+        """
+        groups = [self.attacker, self.defender,
+                  self.att_bullets, self.def_bullets,
+                  self.att_melee, self.def_melee]
+
+        return tuple((tuple(sprite.rect), sprite.color)
+                     for group in groups for sprite in group)
+
     def end(self):
         self.running = False
         self.get_defender().reset()
@@ -331,31 +897,45 @@ class Match():
 class Generation():
 
     DEFAULT_MUTATION = 0.02
+    SELECTION_MODES = ['truncation', 'niching']
+    NICHE_RADIUS = 0.25  # In normalized gene space.
 
     @classmethod
-    def new_random_generation(cls, size, mutation=DEFAULT_MUTATION):
+    def new_random_generation(cls, size, mutation=DEFAULT_MUTATION,
+                              selection='truncation', rng=random):
         """
         Return a new Generation of random robots.
         :param size: Number of robots in Generation.
         :param mutation: Mutation rate for the generation.
+        :param selection: Parent selection mode for the generation.
+        :param rng: Random stream used to create and breed the robots.
         """
         
         robots = []
         
         for i in range(size):
-            robots.append(Robot.new_random_robot())
+            robots.append(Robot.new_random_robot(rng))
 
-        return cls(robots, mutation)
+        return cls(robots, mutation, selection, rng)
 
-    def __init__(self, robots, mutation):
+    def __init__(self, robots, mutation, selection='truncation',
+                 rng=random):
         """
         Initialize the Generation.
         :param robots: Robots of this generation.
         :param mutation: Generational mutation rate.
+        :param selection: 'truncation' picks parents from the top half by
+        fitness, 'niching' from the top half by shared fitness.
+        :param rng: Random stream used for breeding.
         """
+
+        if selection not in Generation.SELECTION_MODES:
+            raise ValueError('Unknown selection mode: {}'.format(selection))
         
         self.robots = robots
         self.mutation = mutation
+        self.selection = selection
+        self.rng = rng
 
     def __iter__(self):
         return iter(self.robots)
@@ -363,6 +943,28 @@ class Generation():
     def get_size(self):
         return len(self.robots)
 
+    def shared_fitness(self):
+        """
+        Return the shared fitness of each robot, in order. Fitness is shifted
+        to be positive, then divided by the niche count of the genome.
+        """
+
+        counts = {}
+        for robot in self.robots:
+            counts[robot.genome] = counts.get(robot.genome, 0) + 1
+
+        # Identical genomes are indexed once, and weighted by their count.
+        genomes = list(counts)
+        index = GenomeIndex(genomes, Generation.NICHE_RADIUS, rng=self.rng)
+
+        niche_counts = dict(zip(genomes, index.niche_counts(
+            [counts[genome] for genome in genomes])))
+
+        lowest = min(robot.fitness for robot in self.robots)
+
+        return [(robot.fitness - lowest + 1) / niche_counts[robot.genome]
+                for robot in self.robots]
+
     def breed(self):
         """
         Return a new Generation bred from current Generation, using a 2 point
@@ -375,6 +977,14 @@ class Generation():
         self.robots.sort(key=lambda x: x.fitness, reverse=True)
         # Effectively using time as a tie breaker.
 
+        if self.selection == 'niching':
+            shared = self.shared_fitness()
+            order = sorted(range(self.get_size()),
+                           key=lambda x: shared[x], reverse=True)
+            parents = [self.robots[x] for x in order]
+        else:
+            parents = self.robots
+
         new_robots = []
 
         i = 0
@@ -388,16 +998,17 @@ class Generation():
                 i += 1
                 continue
             
-            index_one = random.randint(0, self.get_size() // 2)
-            index_two = random.randint(0, self.get_size() // 2)
+            index_one = self.rng.randint(0, self.get_size() // 2)
+            index_two = self.rng.randint(0, self.get_size() // 2)
             while index_one == index_two:
-                index_two = random.randint(0, self.get_size() // 2)
+                index_two = self.rng.randint(0, self.get_size() // 2)
 
-            parent_one = self.robots[index_one]
-            parent_two = self.robots[index_two]
+            parent_one = parents[index_one]
+            parent_two = parents[index_two]
 
             child_one, child_two = parent_one.breed_with(parent_two,
-                                                         self.mutation)
+                                                         self.mutation,
+                                                         self.rng)
 
             if self.get_size() - i > 1:
                 new_robots.append(child_one)
@@ -409,7 +1020,158 @@ class Generation():
 
                 i += 1
 
-        return Generation(new_robots, self.mutation)
+        return Generation(new_robots, self.mutation, self.selection, self.rng)
+
+
+class Population():
+
+    def __init__(self, size, mutation=Generation.DEFAULT_MUTATION,
+                 rng=random):
+        """
+        Initialize a steady state Population. Candidates are pulled with ask
+        and their results pushed back with tell, with no generation barrier.
+        :param size: Number of robots kept in the Population.
+        :param mutation: Mutation rate for bred robots.
+        :param rng: Random stream used to create and breed the robots.
+        """
+
+        if size < 2:
+            raise ValueError('Population needs at least 2 robots to breed')
+
+        self.size = size
+        self.mutation = mutation
+        self.rng = rng
+
+        # (rank, count, robot), best first.
+        self.ranked = []
+        self.evaluations = 0
+        self.pending = []
+
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def rank(robot):
+        """
+        Return the sort key of an evaluated robot. Higher fitness first,
+        then shorter match time, as in Generation.breed.
+        """
+        return (-robot.fitness, robot.match_time)
+
+    def get_size(self):
+        return len(self.ranked)
+
+    def ask(self):
+        """
+        Return a new Robot to evaluate. Random robots are returned until the
+        Population is full, then children bred from the top half.
+        """
+
+        with self.lock:
+            if self.pending:
+                return self.pending.pop()
+
+            if self.get_size() < self.size:
+                return Robot.new_random_robot(self.rng)
+
+            index_one = self.rng.randint(0, self.get_size() // 2)
+            index_two = self.rng.randint(0, self.get_size() // 2)
+            while index_one == index_two:
+                index_two = self.rng.randint(0, self.get_size() // 2)
+
+            parent_one = self.ranked[index_one][2]
+            parent_two = self.ranked[index_two][2]
+
+            child_one, child_two = parent_one.breed_with(parent_two,
+                                                         self.mutation,
+                                                         self.rng)
+
+            self.pending.append(child_two)
+            return child_one
+
+    def tell(self, robot):
+        """
+        Add an evaluated robot to the Population, replacing the worst
+        robot once the Population is full.
+        :param robot: Robot that has finished its Match.
+        """
+
+        with self.lock:
+            self.evaluations += 1
+            bisect.insort(self.ranked,
+                          (Population.rank(robot), self.evaluations, robot))
+
+            if self.get_size() > self.size:
+                self.ranked.pop()
+
+    def candidates(self, count):
+        """
+        Yield count new robots, asking for each only when it is needed.
+        :param count: Number of robots to yield.
+        """
+
+        for i in range(count):
+            yield self.ask()
+
+
+class GenomeIndex():
+
+    TABLES = 8
+
+    def __init__(self, genomes, radius, tables=TABLES, rng=random):
+        """
+        Index genomes in normalized gene space on several randomly shifted
+        grids, with cells as wide as the radius. Two genomes share a cell of
+        a grid with probability equal to the product, over their genes, of
+        1 - (gene distance / radius). So the average cell occupancy over
+        the grids estimates a niche count in linear time.
+        :param genomes: Genomes to index.
+        :param radius: Niche radius, in normalized gene space.
+        :param tables: Number of shifted grids to average over.
+        :param rng: Random stream used for the grid shifts.
+        """
+
+        self.radius = radius
+        self.ranges = Robot.gene_ranges()
+
+        self.points = [self.normalize(genome) for genome in genomes]
+
+        self.shifts = []
+        for i in range(tables):
+            self.shifts.append([rng.random() * radius
+                                for field in genome_fields])
+
+    def normalize(self, genome):
+        """
+        Return the genome as a list of genes scaled to the range 0 to 1.
+        :param genome: Genome to normalize.
+        """
+        return [(value - low) / (high - low)
+                for value, (low, high) in zip(genome, self.ranges)]
+
+    def cell(self, point, shift):
+        return tuple(math.floor((x + offset) / self.radius)
+                     for x, offset in zip(point, shift))
+
+    def niche_counts(self, weights):
+        """
+        Return the estimated niche count of each genome, in order. Each
+        genome counts its own weight in full.
+        :param weights: Weight of each genome, such as its number of copies.
+        """
+
+        totals = [0] * len(self.points)
+
+        for shift in self.shifts:
+            cells = [self.cell(point, shift) for point in self.points]
+
+            occupancy = {}
+            for cell, weight in zip(cells, weights):
+                occupancy[cell] = occupancy.get(cell, 0) + weight
+
+            for i, cell in enumerate(cells):
+                totals[i] += occupancy[cell]
+
+        return [total / len(self.shifts) for total in totals]
 
 
 class Robot(pygame.sprite.Sprite):
@@ -425,73 +1187,100 @@ class Robot(pygame.sprite.Sprite):
     MAX_ACTIONS = 6
     GRAVITY = 1
     OOB_LIMIT = RobotFight.FPS * 3  # 3 Seconds
+    BEHAVIOR_CACHE_SIZE = 100000
+
+    behavior_tables = {}
 
     @classmethod
-    def generate_random_genome(cls):
+    def generate_random_genome(cls, rng=random):
         return Genome(
-            cls.get_random_chest(),
-            cls.get_random_base(),
-            cls.get_random_weapon(),
-            cls.get_random_weapon(),
-            cls.get_random_move(),
-            cls.get_random_move(),
-            cls.get_random_move(),
-            cls.get_random_jump(),
-            cls.get_random_jump(),
-            cls.get_random_jump(),
-            cls.get_random_action(),
-            cls.get_random_action(),
-            cls.get_random_action(),
-            cls.get_random_action(),
-            cls.get_random_action(),
-            cls.get_random_action()
+            cls.get_random_chest(rng),
+            cls.get_random_base(rng),
+            cls.get_random_weapon(rng),
+            cls.get_random_weapon(rng),
+            cls.get_random_move(rng),
+            cls.get_random_move(rng),
+            cls.get_random_move(rng),
+            cls.get_random_jump(rng),
+            cls.get_random_jump(rng),
+            cls.get_random_jump(rng),
+            cls.get_random_action(rng),
+            cls.get_random_action(rng),
+            cls.get_random_action(rng),
+            cls.get_random_action(rng),
+            cls.get_random_action(rng),
+            cls.get_random_action(rng)
         )
 
     @classmethod
-    def get_random_chest(cls):
-        return random.randint(Robot.MIN_CHEST, Robot.MAX_CHEST)
+    def gene_ranges(cls):
+        """
+        Return the (lowest, highest) value of each gene, as a Genome.
+        """
+        return Genome(
+            (cls.MIN_CHEST, cls.MAX_CHEST),
+            (cls.MIN_BASE, cls.MAX_BASE),
+            (0, cls.NUM_WEAPONS),
+            (0, cls.NUM_WEAPONS),
+            (-cls.MAX_MOVE, cls.MAX_MOVE),
+            (-cls.MAX_MOVE, cls.MAX_MOVE),
+            (-cls.MAX_MOVE, cls.MAX_MOVE),
+            (0, 1),
+            (0, 1),
+            (0, 1),
+            (0, 2),
+            (0, 2),
+            (0, 2),
+            (0, 2),
+            (0, 2),
+            (0, 2)
+        )
 
     @classmethod
-    def get_random_base(cls):
-        return random.randint(Robot.MIN_BASE, Robot.MAX_BASE)
+    def get_random_chest(cls, rng=random):
+        return rng.randint(Robot.MIN_CHEST, Robot.MAX_CHEST)
 
     @classmethod
-    def get_random_weapon(cls):
-        return random.randint(0, Robot.NUM_WEAPONS)
+    def get_random_base(cls, rng=random):
+        return rng.randint(Robot.MIN_BASE, Robot.MAX_BASE)
 
     @classmethod
-    def get_random_move(cls):
-        return random.randint(-Robot.MAX_MOVE, Robot.MAX_MOVE)
+    def get_random_weapon(cls, rng=random):
+        return rng.randint(0, Robot.NUM_WEAPONS)
 
     @classmethod
-    def get_random_jump(cls):
-        return random.randint(0, 1)
+    def get_random_move(cls, rng=random):
+        return rng.randint(-Robot.MAX_MOVE, Robot.MAX_MOVE)
 
     @classmethod
-    def get_random_action(cls):
-        return random.randint(0, 2)
+    def get_random_jump(cls, rng=random):
+        return rng.randint(0, 1)
 
     @classmethod
-    def new_random_robot(cls):
-        return cls(cls.generate_random_genome())
+    def get_random_action(cls, rng=random):
+        return rng.randint(0, 2)
 
     @classmethod
-    def mutate_genome(self, genome, rate):
+    def new_random_robot(cls, rng=random):
+        return cls(cls.generate_random_genome(rng), seed=rng.getrandbits(32))
+
+    @classmethod
+    def mutate_genome(self, genome, rate, rng=random):
         new_genome = []
         for i, value in enumerate(genome):
-            if random.random() <= rate:
+            if rng.random() <= rate:
                 if i == 0:
-                    new_genome.append(Robot.get_random_chest())
+                    new_genome.append(Robot.get_random_chest(rng))
                 elif i == 1:
-                    new_genome.append(Robot.get_random_base())
+                    new_genome.append(Robot.get_random_base(rng))
                 elif i <= 3:
-                    new_genome.append(Robot.get_random_weapon())
+                    new_genome.append(Robot.get_random_weapon(rng))
                 elif i <= 6:
-                    new_genome.append(Robot.get_random_move())
+                    new_genome.append(Robot.get_random_move(rng))
                 elif i <= 9:
-                    new_genome.append(Robot.get_random_jump())
+                    new_genome.append(Robot.get_random_jump(rng))
                 elif i <= 15:
-                    new_genome.append(Robot.get_random_action())
+                    new_genome.append(Robot.get_random_action(rng))
                 else:
                     new_genome.append(value)
             else:
@@ -534,27 +1323,69 @@ class Robot(pygame.sprite.Sprite):
             action_five=0,
             action_six=1)
         return cls(genome)
+
+    @classmethod
+    def compile_genome(cls, genome):
+        """
+        Return the behavior table of the genome, compiling it on first use.
+        Tables are cached, so robots with identical genomes share one.
+        :param genome: Genome to compile.
+        """
+
+        table = cls.behavior_tables.get(genome)
+        if table is not None:
+            return table
+
+        moves = (genome.move_one, genome.move_two, genome.move_three)
+        jumps = (genome.jump_one, genome.jump_two, genome.jump_three)
+        actions = (genome.action_one, genome.action_two,
+                   genome.action_three, genome.action_four,
+                   genome.action_five, genome.action_six)
+        arms = (0, genome.arm_one, genome.arm_two)
+        weapons = (None, cls.shoot, cls.melee)
+
+        jump_speed = -10 * (genome.base_size / genome.chest_size)
+
+        # One (move, jump speed, weapon) row per action phase.
+        table = tuple(
+            (moves[phase % 3],
+             jump_speed if jumps[phase % 3] else None,
+             weapons[arms[actions[phase]]])
+            for phase in range(cls.MAX_ACTIONS))
+
+        if len(cls.behavior_tables) >= cls.BEHAVIOR_CACHE_SIZE:
+            cls.behavior_tables.clear()
+        cls.behavior_tables[genome] = table
+
+        return table
             
 
     def __init__(self, genome, direction=1, color=None,
-                 left_parent=0, right_parent=0):
+                 left_parent=0, right_parent=0, seed=None):
         """
         Initialize the Robot.
         :param genome: Genome used for the Robot.
         :param direction: Direction robot should move. 1 or -1
         :param color: RGB Tuple color of the robot.
+        :param seed: Seed of the robot's random stream, used for its color.
         """
 
         pygame.sprite.Sprite.__init__(self)
         
         self.genome = genome
+        self.behavior = Robot.compile_genome(genome)
 
         self.hp = self.genome.chest_size * 2
 
+        if seed is None:
+            seed = random.getrandbits(32)
+        self.seed = seed
+
         if color is None:
-            self.color = (random.randint(10, 245),
-                          random.randint(10, 245),
-                          random.randint(10, 245))
+            rng = random.Random(seed)
+            self.color = (rng.randint(10, 245),
+                          rng.randint(10, 245),
+                          rng.randint(10, 245))
         else:
             self.color = color
 
@@ -590,6 +1421,8 @@ class Robot(pygame.sprite.Sprite):
         self.action_phase = 0
         self.action_switch_count = 0
         self.rect.topleft = (0, 0)
+        self.vertical = 0
+        self.oob_count = 0
         self.fitness = 0
         self.match_time = RobotFight.FPS * 60
 
@@ -607,7 +1440,7 @@ class Robot(pygame.sprite.Sprite):
         if self.action_switch_count >= RobotFight.FPS:
             self.action_phase += 1
 
-            if self.action_phase >= 6:
+            if self.action_phase >= Robot.MAX_ACTIONS:
                 self.action_phase = 0
 
             self.action_switch_count = 0
@@ -621,12 +1454,8 @@ class Robot(pygame.sprite.Sprite):
 
     def move(self):
         
-        if self.action_phase % 3 == 0:
-            self._move_if_clear(self.genome.move_one * self.direction, 0)
-        elif self.action_phase % 3 == 1:
-            self._move_if_clear(self.genome.move_two * self.direction, 0)
-        elif self.action_phase % 3 == 2:
-            self._move_if_clear(self.genome.move_three * self.direction, 0)
+        self._move_if_clear(
+            self.behavior[self.action_phase][0] * self.direction, 0)
 
         if not self.on_floor():
             self.vertical += Robot.GRAVITY
@@ -655,46 +1484,18 @@ class Robot(pygame.sprite.Sprite):
         return self.rect.y >= RobotFight.SCREEN_HEIGHT - Robot.HEIGHT
 
     def check_jump(self):
-        if self.action_phase % 3 == 0 and self.genome.jump_one:
-            self.jump()
-        elif self.action_phase % 3 == 1 and self.genome.jump_two:
-            self.jump()
-        elif self.action_phase % 3 == 2 and self.genome.jump_three:
-            self.jump()
-
-    def jump(self):
+        jump_speed = self.behavior[self.action_phase][1]
+        if jump_speed is not None:
+            self.jump(jump_speed)
+
+    def jump(self, jump_speed):
         self._move_if_clear(0, -1)
-        self.vertical = -10 * (self.genome.base_size / self.genome.chest_size)
+        self.vertical = jump_speed
 
     def action(self):
-
-        if self.action_phase % 6 == 0:
-            action = self.genome.action_one
-        elif self.action_phase % 6 == 1:
-            action = self.genome.action_two
-        elif self.action_phase % 6 == 2:
-            action = self.genome.action_three
-        elif self.action_phase % 6 == 3:
-            action = self.genome.action_four
-        elif self.action_phase % 6 == 4:
-            action = self.genome.action_five
-        elif self.action_phase % 6 == 5:
-            action = self.genome.action_six
-        
-        if action == 0:
-            pass
-        elif action == 1:
-            self._perform_action(self.genome.arm_one)
-        elif action == 2:
-            self._perform_action(self.genome.arm_two)
-
-    def _perform_action(self, weapon):
-        if weapon == 0:
-            pass
-        elif weapon == 1:
-            self.shoot()
-        elif weapon == 2:
-            self.melee()
+        weapon = self.behavior[self.action_phase][2]
+        if weapon is not None:
+            weapon(self)
 
     def shoot(self):
         self.bullet_group.add(Bullet(self, self.direction))
@@ -708,9 +1509,9 @@ class Robot(pygame.sprite.Sprite):
     def hit_oob_limit(self):
         return self.oob_count >= self.OOB_LIMIT
 
-    def breed_with(self, other, mutation):
-        start = random.randint(0, len(self.genome) - 1)
-        end = random.randint(0, len(self.genome) - 1)
+    def breed_with(self, other, mutation, rng=random):
+        start = rng.randint(0, len(self.genome) - 1)
+        end = rng.randint(0, len(self.genome) - 1)
 
         if start > end:
             start, end = end, start
@@ -723,15 +1524,17 @@ class Robot(pygame.sprite.Sprite):
                     + list(self.genome[start:end]) \
                     + list(other.genome[end:])
 
-        genome_one = Robot.mutate_genome(Genome(*child_one), mutation)
-        genome_two = Robot.mutate_genome(Genome(*child_two), mutation)
+        genome_one = Robot.mutate_genome(Genome(*child_one), mutation, rng)
+        genome_two = Robot.mutate_genome(Genome(*child_two), mutation, rng)
 
         robot_one = Robot(genome_one,
                           left_parent=id(self),
-                          right_parent=id(other))
+                          right_parent=id(other),
+                          seed=rng.getrandbits(32))
         robot_two = Robot(genome_two,
                           left_parent=id(self),
-                          right_parent=id(other))
+                          right_parent=id(other),
+                          seed=rng.getrandbits(32))
 
         return robot_one, robot_two
 
@@ -747,10 +1550,10 @@ class Bullet(pygame.sprite.Sprite):
         self.direction = direction
 
         self.image = pygame.Surface([Robot.HEIGHT / 3, Robot.HEIGHT / 3])
-        color = (attacker.color[0] + 10,
-                 attacker.color[1] + 10,
-                 attacker.color[2] + 10)
-        self.image.fill(color)
+        self.color = (attacker.color[0] + 10,
+                      attacker.color[1] + 10,
+                      attacker.color[2] + 10)
+        self.image.fill(self.color)
         
         self.rect = self.image.get_rect()
 
@@ -776,11 +1579,11 @@ class MeleeRange(pygame.sprite.Sprite):
 
         self.image = pygame.Surface(area)
 
-        color = (attacker.color[0] - 10,
-                 attacker.color[1] - 10,
-                 attacker.color[2] - 10)
+        self.color = (attacker.color[0] - 10,
+                      attacker.color[1] - 10,
+                      attacker.color[2] - 10)
         
-        self.image.fill(color)
+        self.image.fill(self.color)
 
         self.rect = self.image.get_rect()
         self.rect.center = attacker.rect.center
@@ -797,6 +1600,46 @@ class MeleeRange(pygame.sprite.Sprite):
         if self.life > RobotFight.FPS:
             self.kill()
 
+def seed_argument(text):
+    """
+    Parse a --seed argument, which must fit in a MatchTrace.
+    :param text: Text of the argument.
+    """
+
+    seed = int(text)
+    if not 0 <= seed <= RobotFight.MAX_SEED:
+        raise argparse.ArgumentTypeError(
+            'seed must be between 0 and {}'.format(RobotFight.MAX_SEED))
+    return seed
+
+
 if __name__ == '__main__':
-    game = RobotFight(10, Robot.new_good_bot())
+    parser = argparse.ArgumentParser(description='Evolve fighting robots.')
+    parser.add_argument('--seed', type=seed_argument,
+                        help='Seed of the run.')
+    parser.add_argument('--steady-state', action='store_true',
+                        help='Breed a steady state Population.')
+    parser.add_argument('--selection', choices=Generation.SELECTION_MODES,
+                        default='truncation',
+                        help='Parent selection mode of each Generation.')
+    parser.add_argument('--store', metavar='DATABASE',
+                        help='Reuse and save match results in a database.')
+    parser.add_argument('--trace', metavar='TRACE',
+                        help='Record every match to a trace file.')
+    parser.add_argument('--replay', metavar='TRACE',
+                        help='Replay a match from a trace file.')
+    parser.add_argument('--generation', type=int, default=1,
+                        help='Generation of the match to replay.')
+    parser.add_argument('--match', type=int, default=1,
+                        help='Number of the match to replay.')
+    args = parser.parse_args()
+
+    if args.replay is not None:
+        game = Replay(args.replay, args.generation, args.match)
+    else:
+        game = RobotFight(10, Robot.new_good_bot(),
+                          steady_state=args.steady_state,
+                          selection=args.selection,
+                          store_path=args.store,
+                          seed=args.seed, trace_path=args.trace)
     game.start()